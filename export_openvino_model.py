@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+One-shot exporter for a statically int8-quantized OpenVINO model
+Run once on the target host, then set ST_BACKEND=openvino and ST_MODEL to the output directory
+"""
+
+import sys
+import logging
+from sentence_transformers import SentenceTransformer, export_static_quantized_openvino_model
+from optimum.intel import OVQuantizationConfig
+
+# Configure logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Same model generate_embeddings.py loads by default
+MODEL_NAME = 'all-MiniLM-L6-v2'
+
+
+def main():
+    """Export MODEL_NAME to OpenVINO and quantize it to int8"""
+    output_dir = sys.argv[1] if len(sys.argv) > 1 else 'models/all-MiniLM-L6-v2'
+
+    try:
+        logger.info(f"Exporting {MODEL_NAME} to OpenVINO...")
+        model = SentenceTransformer(MODEL_NAME, backend='openvino')
+        model.save_pretrained(output_dir)
+
+        logger.info("Calibrating and quantizing to int8...")
+        export_static_quantized_openvino_model(
+            model, OVQuantizationConfig(), output_dir)
+
+        logger.info(f"✅ Exported to {output_dir}")
+        logger.info(
+            f"Run with: ST_BACKEND=openvino ST_MODEL={output_dir} python generate_embeddings.py")
+    except Exception as e:
+        logger.error(f"❌ Failed to export model: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,24 @@ Uses sentence-transformers to generate embeddings locally without external API c
 """
 
 import psycopg2
-import json
+from psycopg2.extras import Json, execute_values
+import functools
+import io
+import struct
 import sys
 import os
+
+# OpenMP/MKL pools are sized when numpy/torch/onnxruntime load, so an explicit
+# ORT_INTRA_OP thread count has to be applied to them before those imports.
+# Only done when run as a script, so importing this module changes no env
+if __name__ == "__main__" and 'ORT_INTRA_OP' in os.environ:
+    os.environ.setdefault('OMP_NUM_THREADS', os.environ['ORT_INTRA_OP'])
+    os.environ.setdefault('MKL_NUM_THREADS', os.environ['ORT_INTRA_OP'])
+
+import numpy as np
 from sentence_transformers import SentenceTransformer
-from typing import List, Dict, Any
+from tqdm import tqdm
+from typing import List, Dict, Optional
 import logging
 
 # Configure logging
@@ -17,49 +30,251 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# all-MiniLM-L6-v2: 384 dimensions, fast and good quality
+MODEL_NAME = 'all-MiniLM-L6-v2'
+
+# Pre-quantized int8 exports shipped in the model's Hugging Face repo, per backend
+DEFAULT_MODEL_FILES = {
+    'onnx': 'onnx/model_qint8_avx512_vnni.onnx',
+    'openvino': 'openvino/openvino_model_qint8_quantized.xml',
+}
+
+# Resource texts are ~60 tokens; capping the sequence length (default 256)
+# bounds padding and the quadratic attention cost
+MAX_SEQ_LENGTH = 96
+
+# Number of texts the model encodes per forward pass
+ENCODE_BATCH_SIZE = 64
+
+# Larger batches keep a GPU busy; used when encoding on CUDA
+GPU_ENCODE_BATCH_SIZE = 256
+
+# Number of rows fetched from the server-side cursor and encoded per chunk
+STREAM_CHUNK_SIZE = 512
+
+# Embedding dimension of MODEL_NAME, must match the halfvec(N) column
+EMBEDDING_DIM = 384
+
+# Embeddings are stored as pgvector halfvec (float16): half the storage and
+# wire bytes of vector, and enough precision for cosine similarity
+EMBEDDING_DTYPE = np.float16
+
+# Rows with no embedding yet, or whose resource_data changed since it was embedded
+PENDING_FILTER = """
+    embedding IS NULL
+    OR resource_data_hash IS DISTINCT FROM md5(resource_data::text)
+"""
+
+# Descriptive text fed to the model for each resource, rendered by Postgres;
+# missing or null fields render as Unknown. has_public_ip follows Python
+# truthiness: false, null, 0, "", [] and {} are No
+RESOURCE_TEXT_QUERY = f"""
+    SELECT id,
+           md5(resource_data::text),
+           format(E'EC2 Instance Configuration:\\n'
+                   'Instance Type: %s\\n'
+                   'State: %s\\n'
+                   'Environment: %s\\n'
+                   'Team: %s\\n'
+                   'Region: %s\\n'
+                   'Public IP: %s',
+                  coalesce(resource_data->>'instance_type', 'Unknown'),
+                  coalesce(resource_data->>'state', 'Unknown'),
+                  coalesce(resource_data->>'environment', 'Unknown'),
+                  coalesce(resource_data->>'team', 'Unknown'),
+                  coalesce(resource_data->>'region', 'Unknown'),
+                  CASE WHEN coalesce(resource_data->'has_public_ip', 'null')
+                            IN ('null', 'false', '0', '""', '[]', '{{}}')
+                       THEN 'No' ELSE 'Yes' END)
+    FROM resource_embeddings
+    WHERE {PENDING_FILTER}
+    ORDER BY id
+"""
+
+# PostgreSQL binary COPY header: signature, flags field, header extension length
+_PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+_PGCOPY_TRAILER = struct.pack('>h', -1)
+
+
+def pack_copy_binary(ids: List[int], hashes: List[Optional[str]],
+                     vectors: np.ndarray) -> io.BytesIO:
+    """Pack (id, data_hash, vector) rows into a COPY ... (FORMAT BINARY) stream
+
+    Each vector field uses pgvector's halfvec binary layout: int16 dim,
+    int16 unused, then dim big-endian float2 values.
+    """
+    data = np.asarray(vectors, dtype='>f2')
+    vec_header = struct.pack('>hh', data.shape[1], 0)
+    buf = io.BytesIO()
+    buf.write(_PGCOPY_HEADER)
+    for resource_id, data_hash, row in zip(ids, hashes, data):
+        vec_bytes = vec_header + row.tobytes()
+        buf.write(struct.pack('>hii', 3, 4, resource_id))
+        if data_hash is None:
+            # NULL resource_data hashes to NULL, sent as field length -1
+            buf.write(struct.pack('>i', -1))
+        else:
+            hash_bytes = data_hash.encode()
+            buf.write(struct.pack('>i', len(hash_bytes)))
+            buf.write(hash_bytes)
+        buf.write(struct.pack('>i', len(vec_bytes)))
+        buf.write(vec_bytes)
+    buf.write(_PGCOPY_TRAILER)
+    buf.seek(0)
+    return buf
+
+
+@functools.lru_cache(maxsize=1)
+def _get_model(name: str, backend: str, file_name: Optional[str],
+               device: str = 'cpu') -> SentenceTransformer:
+    """Load a model once per process; later calls reuse the warm instance"""
+    if backend == 'torch':
+        model = SentenceTransformer(name, device=device)
+        if device == 'cuda':
+            # fp16 weights run on tensor cores
+            model.half()
+        return model
+    model_kwargs = {'file_name': file_name}
+    if backend == 'onnx':
+        model_kwargs['session_options'] = _ort_session_options()
+    return SentenceTransformer(name, backend=backend, model_kwargs=model_kwargs)
+
+
+def _ort_session_options():
+    """Build ONNX Runtime session options from ORT_INTRA_OP
+
+    Without ORT_INTRA_OP, ONNX Runtime keeps its default of one intra-op
+    thread per physical core.
+    """
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    if 'ORT_INTRA_OP' in os.environ:
+        options.intra_op_num_threads = int(os.environ['ORT_INTRA_OP'])
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    return options
+
 
 class LocalEmbeddingGenerator:
     def __init__(self, db_config: Dict[str, str]):
         """Initialize the embedding generator with database connection details"""
         self.db_config = db_config
         self.model = None
+        self.pool = None
+        self.pool_parent_threads = None
+        self.backend = None
+        self.device = None
+        self.batch_size = ENCODE_BATCH_SIZE
 
     def load_model(self):
         """Load the sentence transformer model (downloads once, then runs locally)"""
         try:
-            logger.info("Loading sentence transformer model...")
-            # Use all-MiniLM-L6-v2: 384 dimensions, fast and good quality
-            self.model = SentenceTransformer('all-MiniLM-L6-v2')
+            import torch
+
+            # Encode on the GPU when one is available; the int8 ONNX export
+            # targets CPUs, so CUDA hosts default to the PyTorch backend
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+            # Backend is one of torch, onnx or openvino; ST_MODEL points at a
+            # local export and ST_MODEL_FILE overrides the quantized file loaded
+            model_name = os.environ.get('ST_MODEL', MODEL_NAME)
+            backend = (os.environ.get('ST_BACKEND')
+                       or ('torch' if device == 'cuda' else 'onnx'))
+            model_file = os.environ.get('ST_MODEL_FILE',
+                                        DEFAULT_MODEL_FILES.get(backend))
+            logger.info(
+                f"Loading sentence transformer model ({backend} backend on {device})...")
+            try:
+                self.model = _get_model(model_name, backend, model_file, device)
+            except Exception as e:
+                if backend == 'torch':
+                    raise
+                logger.warning(
+                    f"{backend} model unavailable ({e}), falling back to PyTorch backend")
+                self.model = _get_model(MODEL_NAME, 'torch', None, device)
+                backend = 'torch'
+            self.backend = backend
+
+            # Only the torch backend is placed on the GPU; onnx/openvino run on CPU
+            self.device = device if backend == 'torch' else 'cpu'
+            self.batch_size = (GPU_ENCODE_BATCH_SIZE if self.device == 'cuda'
+                               else ENCODE_BATCH_SIZE)
+            self.model.max_seq_length = MAX_SEQ_LENGTH
             logger.info("Model loaded successfully!")
         except Exception as e:
             logger.error(f"Failed to load model: {e}")
             raise
 
-    def get_embedding(self, text: str) -> List[float]:
-        """Generate embedding locally using sentence-transformers"""
+    def get_embeddings(self, texts: List[str]) -> np.ndarray:
+        """Generate embeddings for a batch of texts in a single encode call"""
         if not self.model:
             raise RuntimeError("Model not loaded. Call load_model() first.")
 
         try:
-            embedding = self.model.encode(text)
-            return embedding.tolist()
+            # Identical configurations produce identical text, so encode each
+            # distinct text once and fan the vectors back out
+            positions = {}
+            inverse = [positions.setdefault(text, len(positions))
+                       for text in texts]
+            unique_texts = list(positions)
+
+            if self.pool:
+                embeddings = self.model.encode_multi_process(
+                    unique_texts, self.pool, batch_size=self.batch_size,
+                    show_progress_bar=False, normalize_embeddings=True)
+            else:
+                embeddings = self.model.encode(unique_texts,
+                                               batch_size=self.batch_size,
+                                               show_progress_bar=False,
+                                               convert_to_numpy=True,
+                                               normalize_embeddings=True)
+            return embeddings.astype(EMBEDDING_DTYPE)[inverse]
         except Exception as e:
-            logger.error(f"Failed to generate embedding: {e}")
+            logger.error(f"Failed to generate embeddings: {e}")
             raise
 
-    def format_resource_text(self, resource_data: Dict[str, Any]) -> str:
-        """Format resource data as descriptive text for better embeddings"""
+    def start_pool(self, processes: int):
+        """Start a pool of encoder processes, one model replica per CPU worker
+
+        processes=0 starts one worker per physical core, i.e. torch's default
+        intra-op thread count.
+        """
+        import torch
+
+        self.pool_parent_threads = torch.get_num_threads()
+        if not processes:
+            processes = self.pool_parent_threads
+
+        # Workers are spawned as fresh interpreters that size their thread pools
+        # from the inherited environment, so cap them at one thread each while
+        # spawning; the parent only dispatches work while the pool runs
+        saved_env = {name: os.environ.get(name)
+                     for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS')}
+        os.environ.update({name: '1' for name in saved_env})
         try:
-            return f"""EC2 Instance Configuration:
-Instance Type: {resource_data.get('instance_type', 'Unknown')}
-State: {resource_data.get('state', 'Unknown')}
-Environment: {resource_data.get('environment', 'Unknown')}
-Team: {resource_data.get('team', 'Unknown')}
-Region: {resource_data.get('region', 'Unknown')}
-Public IP: {'Yes' if resource_data.get('has_public_ip') else 'No'}""".strip()
-        except Exception as e:
-            logger.error(f"Failed to format resource text: {e}")
-            return str(resource_data)
+            logger.info(f"Starting {processes} encoder processes...")
+            self.pool = self.model.start_multi_process_pool(['cpu'] * processes)
+        finally:
+            for name, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+        torch.set_num_threads(1)
+
+    def stop_pool(self):
+        """Stop the encoder process pool if one is running"""
+        if self.pool:
+            import torch
+
+            self.model.stop_multi_process_pool(self.pool)
+            self.pool = None
+            torch.set_num_threads(self.pool_parent_threads)
+
+    def get_embedding(self, text: str) -> np.ndarray:
+        """Generate embedding locally using sentence-transformers"""
+        return self.get_embeddings([text])[0]
 
     def update_embeddings(self):
         """Update all resource embeddings with local vectors"""
@@ -70,59 +285,191 @@ Public IP: {'Yes' if resource_data.get('has_public_ip') else 'No'}""".strip()
             conn = psycopg2.connect(**self.db_config)
             cursor = conn.cursor()
 
-            # Get all resources that need embeddings
-            logger.info("Fetching resources from database...")
-            cursor.execute("""
-                SELECT id, resource_type, resource_id, resource_data 
-                FROM resource_embeddings
-                ORDER BY id
-            """)
-
-            resources = cursor.fetchall()
-            logger.info(f"Found {len(resources)} resources to process")
+            # Schema migrations take ACCESS EXCLUSIVE locks; commit them on
+            # their own so readers aren't blocked for the whole encoding run
+            self.ensure_schema(cursor)
+            conn.commit()
 
-            if not resources:
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM resource_embeddings)")
+            if not cursor.fetchone()[0]:
                 logger.info(
                     "No resources found. Creating sample embeddings...")
                 self.create_sample_embeddings(cursor)
-                resources = cursor.fetchall()
 
-            # Process each resource
-            for i, (resource_id, resource_type, resource_id_str, resource_data) in enumerate(resources):
-                logger.info(
-                    f"Processing resource {i+1}/{len(resources)}: {resource_type} - {resource_id_str}")
-
-                # Convert resource data to descriptive text
-                text_content = self.format_resource_text(resource_data)
-
-                # Generate local embedding
-                embedding_vector = self.get_embedding(text_content)
-
-                # Update database
-                cursor.execute("""
-                    UPDATE resource_embeddings 
-                    SET embedding = %s::vector 
-                    WHERE id = %s
-                """, (embedding_vector, resource_id))
-
-                logger.info(f"Updated embedding for resource {resource_id}")
+            # Only rows without an up-to-date embedding are re-encoded
+            cursor.execute(
+                f"SELECT COUNT(*) FROM resource_embeddings WHERE {PENDING_FILTER}")
+            total = cursor.fetchone()[0]
+            logger.info(f"Found {total} resources to process")
+
+            self.create_staging_table(cursor)
+
+            # ST_PROCS > 1 spreads encoding over that many processes (0 = one per
+            # physical core). Only torch models can be replicated into workers;
+            # ONNX Runtime and OpenVINO sessions don't survive pickling
+            procs = int(os.environ.get('ST_PROCS', '1'))
+            if procs != 1 and self.backend != 'torch':
+                logger.warning(
+                    f"ST_PROCS={procs} ignored: multi-process encoding requires "
+                    f"the torch backend (loaded {self.backend})")
+            elif procs != 1 and self.device == 'cuda':
+                # The pool would move the cached fp16 model off the GPU onto CPU workers
+                logger.warning(
+                    f"ST_PROCS={procs} ignored: encoding on the GPU in-process")
+            elif procs != 1:
+                self.start_pool(procs)
+
+            # Stream resources through a server-side cursor so only one chunk
+            # is held in memory at a time
+            logger.info("Fetching resources from database...")
+            stream = conn.cursor(name='emb_stream')
+            stream.itersize = STREAM_CHUNK_SIZE
+            # Text is formatted by Postgres, so resource_data is never
+            # deserialized into Python dicts
+            stream.execute(RESOURCE_TEXT_QUERY)
+
+            processed = 0
+            updated = 0
+            with tqdm(total=total, desc="Embedding resources", unit="res") as progress:
+                for chunk in iter(lambda: stream.fetchmany(STREAM_CHUNK_SIZE), []):
+                    ids = [r[0] for r in chunk]
+                    hashes = [r[1] for r in chunk]
+                    texts = [r[2] for r in chunk]
+                    vectors = self.get_embeddings(texts)
+
+                    # Stream vectors in binary into the staging table, then swap them in
+                    updated += self.write_embeddings(cursor, ids, hashes, vectors)
+                    processed += len(ids)
+                    progress.update(len(ids))
+                    logger.debug(f"Updated embeddings for {processed} resources")
+
+            stream.close()
+            logger.info(f"Generated embeddings for {processed} resources")
+
+            self.ensure_embedding_index(cursor)
+
+            # Every streamed row must have been written, otherwise roll back the
+            # whole run rather than committing a partial update
+            if updated != processed:
+                raise RuntimeError(
+                    f"Updated {updated} rows but encoded {processed} resources")
+
+            # Incremental runs with nothing to encode skip the table-wide work
+            if processed:
+                cursor.execute("ANALYZE resource_embeddings")
+                self.verify_embeddings(cursor)
 
             # Commit changes
             conn.commit()
             logger.info("All embeddings updated successfully!")
 
-            # Verify the embeddings
-            self.verify_embeddings(cursor)
-
         except Exception as e:
             logger.error(f"Failed to update embeddings: {e}")
             if conn:
                 conn.rollback()
             raise
         finally:
+            self.stop_pool()
             if conn:
                 conn.close()
 
+    def ensure_schema(self, cursor):
+        """Migrate databases created from an older init.sql to the current schema
+
+        Each ALTER runs only when needed, since even a no-op ALTER TABLE takes
+        an ACCESS EXCLUSIVE lock.
+        """
+        if self.column_type(cursor, 'resource_data_hash') is None:
+            logger.info("Adding resource_data_hash column...")
+            cursor.execute("""
+                ALTER TABLE resource_embeddings
+                ADD COLUMN resource_data_hash TEXT
+            """)
+
+        column_type = self.column_type(cursor, 'embedding')
+        if column_type is None:
+            raise RuntimeError(
+                "resource_embeddings has no embedding column; recreate it from init.sql")
+        if column_type == f"halfvec({EMBEDDING_DIM})":
+            return
+
+        logger.info(
+            f"Migrating embedding column from {column_type} to halfvec({EMBEDDING_DIM})...")
+        # vector_cosine_ops indexes can't be converted in place; the halfvec
+        # index is rebuilt by ensure_embedding_index once the rows are re-encoded
+        for index_name in self.embedding_indexes(cursor):
+            cursor.execute(f"DROP INDEX {index_name}")
+        cursor.execute(f"""
+            ALTER TABLE resource_embeddings
+            ALTER COLUMN embedding TYPE halfvec({EMBEDDING_DIM})
+            USING embedding::halfvec({EMBEDDING_DIM})
+        """)
+
+    def embedding_indexes(self, cursor) -> List[str]:
+        """Return the names of indexes covering the embedding column"""
+        cursor.execute("""
+            SELECT i.indexrelid::regclass::text
+            FROM pg_index i
+            JOIN pg_attribute a
+              ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+            WHERE i.indrelid = 'resource_embeddings'::regclass
+              AND a.attname = 'embedding'
+        """)
+        return [row[0] for row in cursor.fetchall()]
+
+    def ensure_embedding_index(self, cursor):
+        """Create the ivfflat index if a migration dropped it
+
+        Runs after write_embeddings so the index's list centroids are trained
+        on the new embeddings rather than the vectors being replaced.
+        """
+        if self.embedding_indexes(cursor):
+            return
+
+        logger.info("Building ivfflat index on embeddings...")
+        cursor.execute("""
+            CREATE INDEX ON resource_embeddings USING ivfflat (embedding halfvec_cosine_ops)
+            WITH (lists = 100)
+        """)
+
+    def column_type(self, cursor, column: str) -> Optional[str]:
+        """Return the SQL type of a resource_embeddings column, or None if it doesn't exist"""
+        cursor.execute("""
+            SELECT format_type(atttypid, atttypmod)
+            FROM pg_attribute
+            WHERE attrelid = 'resource_embeddings'::regclass
+              AND attname = %s
+              AND NOT attisdropped
+        """, (column,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def create_staging_table(self, cursor):
+        """Create the per-transaction staging table used by write_embeddings"""
+        cursor.execute(f"""
+            CREATE TEMP TABLE _emb_stage (
+                id int, data_hash text, emb halfvec({EMBEDDING_DIM}))
+            ON COMMIT DROP
+        """)
+
+    def write_embeddings(self, cursor, ids: List[int], hashes: List[Optional[str]],
+                         vectors: np.ndarray) -> int:
+        """Write embeddings via binary COPY and one UPDATE, returning rows updated
+
+        The resource_data hash each vector was computed from is stored
+        alongside it so unchanged rows are skipped on the next run.
+        """
+        cursor.execute("TRUNCATE _emb_stage")
+        cursor.copy_expert("COPY _emb_stage FROM STDIN WITH (FORMAT BINARY)",
+                           pack_copy_binary(ids, hashes, vectors))
+        cursor.execute("""
+            UPDATE resource_embeddings r
+            SET embedding = s.emb, resource_data_hash = s.data_hash
+            FROM _emb_stage s
+            WHERE r.id = s.id
+        """)
+        return cursor.rowcount
+
     def create_sample_embeddings(self, cursor):
         """Create sample resource embeddings if none exist"""
         logger.info("Creating sample resource embeddings...")
@@ -154,14 +501,14 @@ Public IP: {'Yes' if resource_data.get('has_public_ip') else 'No'}""".strip()
             })
         ]
 
-        for resource_type, resource_id, resource_data in sample_resources:
-            cursor.execute("""
-                INSERT INTO resource_embeddings (resource_type, resource_id, resource_data, embedding)
-                VALUES (%s, %s, %s, NULL)
-                ON CONFLICT (resource_type, resource_id) DO NOTHING
-            """, (resource_type, resource_id, json.dumps(resource_data)))
+        execute_values(cursor, """
+            INSERT INTO resource_embeddings (resource_type, resource_id, resource_data, embedding)
+            VALUES %s
+            ON CONFLICT (resource_type, resource_id) DO NOTHING
+        """, [(resource_type, resource_id, Json(resource_data), None)
+              for resource_type, resource_id, resource_data in sample_resources])
 
-        conn.commit()
+        cursor.connection.commit()
         logger.info("Sample resources created")
 
     def verify_embeddings(self, cursor):
@@ -191,7 +538,7 @@ Public IP: {'Yes' if resource_data.get('has_public_ip') else 'No'}""".strip()
         # Show a sample embedding
         cursor.execute("""
             SELECT resource_type, resource_id, 
-                   array_to_string(embedding::float4[], ',') as sample_vector
+                   (embedding::real[])[1:5] as sample_vector
             FROM resource_embeddings 
             WHERE embedding IS NOT NULL 
             LIMIT 1
@@ -201,8 +548,7 @@ Public IP: {'Yes' if resource_data.get('has_public_ip') else 'No'}""".strip()
         if sample:
             logger.info(f"Sample embedding: {sample[0]} - {sample[1]}")
             # Show first few dimensions
-            vector_str = sample[2]
-            first_few = ','.join(vector_str.split(',')[:5])
+            first_few = ','.join(map(str, sample[2]))
             logger.info(f"Vector preview (first 5 dimensions): [{first_few}]")
 
 
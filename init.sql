@@ -7,10 +7,11 @@ CREATE TABLE IF NOT EXISTS resource_embeddings (
     resource_type VARCHAR(100) NOT NULL,
     resource_id VARCHAR(255) NOT NULL,
     resource_data JSONB,
-    embedding vector(384), -- OpenAI text-embedding-3-small dimension
+    embedding halfvec(384), -- all-MiniLM-L6-v2 dimension, stored as float16
+    resource_data_hash TEXT, -- md5 of resource_data the embedding was generated from
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     UNIQUE(resource_type, resource_id)
 );
 
-CREATE INDEX ON resource_embeddings USING ivfflat (embedding vector_cosine_ops)
+CREATE INDEX ON resource_embeddings USING ivfflat (embedding halfvec_cosine_ops)
 WITH (lists = 100);
\ No newline at end of file